@@ -0,0 +1,338 @@
+"""Long lived local agent.
+
+`ebrains_util serve` keeps a warm token, pooled connections and (opt-in,
+EBRAINS_UTIL_AGENT_LS_TTL) bucket listings in one process, and accepts ls/download/upload jobs over a unix socket.
+The `ebrains_util` entry point (main) delegates such jobs to the agent if it is
+running, otherwise falls back to the regular cli.
+
+n.b. the client side of this module must only use the standard library, so that
+delegating a job does not pay for importing click, ebrains_drive etc.
+"""
+from hashlib import sha256
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+from .config import (
+    EBRAINS_UTIL_AGENT_SOCKET,
+    EBRAINS_UTIL_AGENT_LS_TTL,
+    EBRAINS_UTIL_NO_AGENT,
+    EBRAINS_UTIL_AUTH_TOKEN,
+    EBRAINS_UTIL_CLIENT_ID,
+    EBRAINS_UTIL_CLIENT_SECRET,
+    EBRAINS_UTIL_REFRESH_TOKEN,
+    EBRAINS_UTIL_TOKEN_SCOPE,
+    token_path,
+)
+
+
+def credentials_fingerprint() -> str:
+    """Fingerprint of the credentials in env vars. The agent only runs jobs from
+    clients with the same fingerprint, so a job never runs with another identity."""
+    credentials = [
+        EBRAINS_UTIL_AUTH_TOKEN,
+        EBRAINS_UTIL_CLIENT_ID,
+        EBRAINS_UTIL_CLIENT_SECRET,
+        EBRAINS_UTIL_REFRESH_TOKEN,
+        EBRAINS_UTIL_TOKEN_SCOPE,
+    ]
+    return sha256(json.dumps(credentials).encode("utf-8")).hexdigest()
+
+
+# client
+
+
+def _parse_args(args: List[str], value_opts: Dict[str, str], flag_opts: Dict[str, str], stop_at_positional=False) -> Optional[Tuple[Dict, List[str], List[str]]]:
+    """Minimal option parser. Returns (options, positionals, remaining args), or None if
+    an unknown option is encountered (in which case the job is left to the cli)."""
+    opts, positionals = {}, []
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg == "-" or not arg.startswith("-"):
+            positionals.append(arg)
+            if stop_at_positional:
+                break
+            continue
+        name, eq, value = arg.partition("=")
+        if name in flag_opts and not eq:
+            opts[flag_opts[name]] = True
+            continue
+        if name in value_opts:
+            if not eq:
+                if not args:
+                    return None
+                value = args.pop(0)
+            opts[value_opts[name]] = value
+            continue
+        return None
+    return opts, positionals, args
+
+
+def parse_job(argv: List[str]) -> Optional[Dict]:
+    """Translate cli argv into an agent job. Returns None if argv cannot be delegated."""
+    if not argv:
+        return None
+    command, *rest = argv
+    cwd = os.getcwd()
+
+    if command == "download":
+        parsed = _parse_args(rest, {
+            "-i": "input_file", "--input": "input_file",
+            "-o": "outdir", "--outdir": "outdir",
+            "--max-workers": "max_workers",
+        }, {})
+        if parsed is None:
+            return None
+        opts, positionals, _ = parsed
+        if len(positionals) == 1 and not opts:
+            return {"op": "download", "cwd": cwd, "url": positionals[0]}
+        input_file = opts.get("input_file")
+        if len(positionals) == 0 and input_file and input_file != "-" and "max_workers" not in opts:
+            return {"op": "download_all", "cwd": cwd, "input_file": input_file, "outdir": opts.get("outdir", ".")}
+        return None
+
+    if command == "upload":
+        if len(rest) == 2 and not any(arg.startswith("-") for arg in rest):
+            url, file = rest
+            return {"op": "upload", "cwd": cwd, "url": url, "file": file}
+        return None
+
+    if command == "bucket":
+        parsed = _parse_args(rest, {"-n": "bucket_name", "--bucket-name": "bucket_name"}, {}, stop_at_positional=True)
+        if parsed is None:
+            return None
+        group_opts, subcommand, rest = parsed
+        if subcommand != ["ls"] or "bucket_name" not in group_opts:
+            return None
+        parsed = _parse_args(rest, {"--prefix": "prefix"}, {"--json": "json"})
+        if parsed is None or parsed[1]:
+            return None
+        opts, _, _ = parsed
+        return {
+            "op": "ls",
+            "cwd": cwd,
+            "bucket_name": group_opts["bucket_name"],
+            "prefix": opts.get("prefix"),
+            "json": opts.get("json", False),
+        }
+    return None
+
+
+def _connect(socket_path: str = None) -> Optional[socket.socket]:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path or EBRAINS_UTIL_AGENT_SOCKET)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def delegate(job: Dict, socket_path: str = None) -> Optional[int]:
+    """Send job to the agent and relay its output. Returns the exit code, or None if no agent
+    is running or the agent refused the job (e.g. different credentials)."""
+    if not os.path.exists(socket_path or EBRAINS_UTIL_AGENT_SOCKET):
+        return None
+    sock = _connect(socket_path)
+    if sock is None:
+        return None
+    streams = {"stdout": sys.stdout, "stderr": sys.stderr}
+    with sock, sock.makefile("rwb") as fh:
+        fh.write((json.dumps({**job, "credentials": credentials_fingerprint()}) + "\n").encode("utf-8"))
+        fh.flush()
+        for line in fh:
+            msg = json.loads(line)
+            if "refused" in msg:
+                return None
+            if "exit" in msg:
+                return msg["exit"]
+            stream = streams[msg["stream"]]
+            stream.write(msg["data"])
+            stream.flush()
+    print("Connection to ebrains_util agent lost.", file=sys.stderr)
+    return 1
+
+
+def main():
+    """Entry point. Delegate to the agent if possible, otherwise run the cli."""
+    job = None if EBRAINS_UTIL_NO_AGENT else parse_job(sys.argv[1:])
+    if job is not None:
+        exit_code = delegate(job)
+        if exit_code is not None:
+            sys.exit(exit_code)
+
+    from .commands import cli
+    cli()
+
+
+# server
+
+
+class AgentState:
+    """State kept warm across jobs."""
+
+    def __init__(self) -> None:
+        from .bucket.transfer import ClientPool, UrlDownloader
+        self.pool = ClientPool()
+        self.downloader = UrlDownloader(self.pool)
+        self._lock = threading.Lock()
+        self._ls_cache: Dict[Tuple[str, str], Tuple[float, List[str]]] = {}
+        self._token_mtime = None
+
+    def _check_token(self):
+        # token file changes on login/logout/set-token
+        mtime = token_path.stat().st_mtime if token_path.exists() else None
+        if mtime != self._token_mtime:
+            self._token_mtime = mtime
+            self.pool.invalidate_token()
+
+    def run(self, job: Dict, emit: Callable[[str, str], None]) -> int:
+        handler = getattr(self, f"_do_{job.get('op')}", None)
+        if handler is None:
+            emit("stderr", f"Unknown job {job.get('op')}\n")
+            return 1
+        self._check_token()
+        return handler(job, emit) or 0
+
+    def _do_ls(self, job: Dict, emit: Callable[[str, str], None]):
+        bucket_name, prefix = job["bucket_name"], job.get("prefix")
+        if self.pool.get_token() is None:
+            emit("stderr", "Not authenticated. Using anonymous client. Only has read access to public buckets\n")
+
+        with self._lock:
+            cached = self._ls_cache.get((bucket_name, prefix))
+        if cached and time.time() - cached[0] < EBRAINS_UTIL_AGENT_LS_TTL:
+            all_names = cached[1]
+        else:
+            bucket = self.pool.get_bucket(bucket_name)
+            all_names = [f.name for f in bucket.ls(prefix=prefix)]
+            if EBRAINS_UTIL_AGENT_LS_TTL > 0:
+                with self._lock:
+                    self._ls_cache[(bucket_name, prefix)] = (time.time(), all_names)
+
+        if len(all_names) == 0:
+            emit("stderr", "Could not find any file.\n")
+            return
+        if job.get("json"):
+            emit("stdout", json.dumps(all_names) + "\n")
+            return
+        emit("stdout", "\n".join(all_names) + "\n")
+
+    def _do_download(self, job: Dict, emit: Callable[[str, str], None]):
+        from .bucket.util import parse_dataproxy_url
+        url = job["url"]
+        _, _, fname = parse_dataproxy_url(url)
+        if not fname:
+            raise RuntimeError(f"{url=} does not point to a file")
+        self.downloader.download(url, Path(job["cwd"]) / fname)
+        emit("stderr", f"Successfully downloaded {url}\n")
+
+    def _do_download_all(self, job: Dict, emit: Callable[[str, str], None]):
+        cwd = Path(job["cwd"])
+        lines = (cwd / job["input_file"]).read_text().splitlines()
+        urls = [line.strip() for line in lines if line.strip() and not line.strip().startswith("#")]
+
+        def on_done(url: str, error: Exception):
+            if error is not None:
+                emit("stderr", f"Failed to download {url}: {str(error)}\n")
+
+        failed = self.downloader.download_all(urls, cwd / job["outdir"], callback=on_done)
+        if failed:
+            emit("stderr", f"{len(failed)} of {len(urls)} downloads failed.\n")
+            return 1
+        emit("stderr", f"Successfully downloaded {len(urls)} files\n")
+
+    def _do_upload(self, job: Dict, emit: Callable[[str, str], None]):
+        from .bucket.util import parse_dataproxy_url
+        bucketname, fpath, fname = parse_dataproxy_url(job["url"])
+        file = job["file"]
+        self.pool.require_token()
+        bucket = self.pool.get_bucket(bucketname)
+        upload_path = fname or f"{fpath or ''}{Path(file).name}"
+
+        emit("stderr", f"Uploading to {bucketname=} {upload_path=}\n")
+        bucket.upload(str(Path(job["cwd"]) / file), upload_path)
+        with self._lock:
+            for key in [key for key in self._ls_cache if key[0] == bucketname]:
+                self._ls_cache.pop(key)
+        emit("stderr", "Success!\n")
+
+
+class _AgentHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        job = json.loads(line)
+
+        if job.get("op") == "shutdown":
+            self._send({"exit": 0})
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+            return
+
+        if job.get("credentials") != self.server.credentials:
+            # client would authenticate differently, let it run the job itself
+            self._send({"refused": "credentials differ from the agent's"})
+            return
+
+        def emit(stream: str, data: str):
+            self._send({"stream": stream, "data": data})
+
+        try:
+            exit_code = self.server.state.run(job, emit)
+        except Exception as e:
+            emit("stderr", f"{job.get('op')} failed: {str(e)}\n")
+            exit_code = 1
+        self._send({"exit": exit_code})
+
+    def _send(self, msg: Dict):
+        self.wfile.write((json.dumps(msg) + "\n").encode("utf-8"))
+        self.wfile.flush()
+
+
+class _AgentServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(socket_path: str = None):
+    """Run the agent in the foreground until stopped (SIGINT/SIGTERM or stop())."""
+    path = Path(socket_path or EBRAINS_UTIL_AGENT_SOCKET)
+    if path.exists():
+        sock = _connect(str(path))
+        if sock is not None:
+            sock.close()
+            raise RuntimeError(f"Agent is already running at {str(path)}")
+        path.unlink()
+    path.parent.mkdir(parents=True, exist_ok=True, mode=0o700)
+
+    def on_sigterm(signum, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, on_sigterm)
+
+    state = AgentState()
+    with _AgentServer(str(path), _AgentHandler) as server:
+        path.chmod(0o600)
+        server.state = state
+        server.credentials = credentials_fingerprint()
+        print(f"Agent listening on {str(path)}", file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if path.exists():
+                path.unlink()
+
+
+def stop(socket_path: str = None) -> bool:
+    """Stop the running agent. Returns False if no agent is running."""
+    return delegate({"op": "shutdown"}, socket_path) is not None
@@ -7,6 +7,7 @@ from typing import Union, Callable
 import json
 import os
 import shutil
+import signal
 import sys
 
 from ebrains_drive import BucketApiClient
@@ -34,11 +35,16 @@ class CtxBucket:
 
 pass_bucket = click.make_pass_decorator(CtxBucket)
 
+# commands that take bucket names from their URL arguments instead of --bucket-name
+_URL_COMMANDS = ("cp",)
+
 @click.group()
-@click.option("--bucket-name", "-n", required=True, type=str, help="Name of the bucket.")
+@click.option("--bucket-name", "-n", required=False, type=str, help="Name of the bucket. Required, except for cp.")
 @click.pass_context
 def bucket(ctx, bucket_name: str):
-    """Bucket API (ls/upload/download)"""
+    """Bucket API (ls/upload/download/cp)"""
+    if bucket_name is None and ctx.invoked_subcommand not in _URL_COMMANDS:
+        raise click.UsageError("Missing option '--bucket-name' / '-n'.")
     ctx.obj = CtxBucket(bucket_name=bucket_name)
 
 
@@ -185,11 +191,33 @@ bucket.add_command(upload, "upload")
 @click.option("--reverse", "reverse_flag", help="Sync download. If set, will try to get token. If does not exist, will try to download file as if the bucket is public. Ignores --hash flag.", is_flag=True)
 @click.option("-C", "relative_to", help="If upload, upload path is determined relative to this path", type=str, default=None)
 @click.option("--max-workers", "max_workers", help="Configure max parallel", type=int, default=None)
+@click.option("--resume", "resume_flag", help="Upload only. Record progress in a journal under EBRAINS_UTIL_USER_PATH. On first run, skip files already in the bucket (same size, not older than local). If a previous --resume run was interrupted, upload only the files it did not confirm. Ignores --hash flag.", is_flag=True)
+@click.option("--rescan", "rescan_flag", help="With --resume, rescan SRCPATH before resuming, to pick up new and changed (size/mtime) files.", is_flag=True)
 @click.argument("srcpath", required=True, type=str)
 @click.argument("dstpath", required=False, default=".", type=str)
 @pass_bucket
-def sync(bucket_ctx: CtxBucket, hash_flag: bool, reverse_flag:bool, relative_to:str, max_workers:int, srcpath: str, dstpath: str):
+def sync(bucket_ctx: CtxBucket, hash_flag: bool, reverse_flag:bool, relative_to:str, max_workers:int, resume_flag: bool, rescan_flag: bool, srcpath: str, dstpath: str):
     """Sync directory/file."""
+    if resume_flag:
+        if reverse_flag:
+            raise click.UsageError("--resume cannot be used with --reverse")
+        from .journal import sync_with_journal, SyncIncompleteException
+
+        def on_sigterm(signum, frame):
+            # e.g. job time limit. exit via SystemExit, so that the journal is flushed
+            raise SystemExit(143)
+
+        signal.signal(signal.SIGTERM, on_sigterm)
+        try:
+            sync_with_journal(bucket_ctx.bucket_name, Path(srcpath), dstpath, relative_to=relative_to, max_workers=max_workers, rescan=rescan_flag)
+        except SyncIncompleteException as e:
+            print(f"Sync incomplete: {str(e)}", file=sys.stderr)
+            sys.exit(1)
+        return
+
+    if rescan_flag:
+        raise click.UsageError("--rescan can only be used with --resume")
+
     if reverse_flag:
         from ebrains_dataproxy_sync.sync.dataproxy import sync_down
         try:
@@ -221,3 +249,37 @@ def sync(bucket_ctx: CtxBucket, hash_flag: bool, reverse_flag:bool, relative_to:
             os.environ["AUTH_TOKEN"] = prev_auth_token
             
 bucket.add_command(sync, "sync")
+
+
+@click.command()
+@click.option("--recursive", "-r", help="Copy all objects under the SRC_URL prefix, preserving their path relative to it.", is_flag=True)
+@click.option("--max-workers", "max_workers", help="Configure max parallel", type=int, default=None)
+@click.argument("src_url", required=True, type=str)
+@click.argument("dst_url", required=True, type=str)
+def cp(recursive: bool, max_workers: int, src_url: str, dst_url: str):
+    """Copy object(s) from one bucket to another, without downloading to disk.
+
+    SRC_URL and DST_URL accept the same URLs as the top level download/upload
+    (or a bucket name). If DST_URL does not point to a file, objects are copied
+    under its prefix."""
+    from .transfer import BucketCopier, ClientPool, plan_copy
+    pool = ClientPool(max_workers=max_workers)
+    jobs = plan_copy(pool, src_url, dst_url, recursive=recursive)
+    if len(jobs) == 0:
+        print("Could not find any file.", file=sys.stderr)
+        return
+
+    with tqdm.tqdm(total=len(jobs)) as progress:
+        def on_done(job, error: Exception):
+            progress.update(1)
+            if error is not None:
+                progress.write(f"Failed to copy {job}: {str(error)}", file=sys.stderr)
+
+        failed = BucketCopier(pool).copy_all(jobs, callback=on_done)
+
+    if failed:
+        print(f"{len(failed)} of {len(jobs)} copies failed.", file=sys.stderr)
+        sys.exit(1)
+    print(f"Successfully copied {len(jobs)} files", file=sys.stderr)
+
+bucket.add_command(cp, "cp")
@@ -0,0 +1,228 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from hashlib import sha256
+from pathlib import Path, PurePosixPath
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+import json
+import os
+import sqlite3
+import sys
+import time
+
+import tqdm
+
+from .transfer import ClientPool
+from ..config import EBRAINS_UTIL_USER_PATH
+
+
+class SyncIncompleteException(Exception): pass
+
+
+class TransferJournal:
+    """SQLite journal of a sync: the planned transfer set, and which files are confirmed done.
+
+    Completions are buffered and committed in batches (every FLUSH_EVERY files or
+    FLUSH_INTERVAL seconds), so at most the last batch is re-uploaded after a crash."""
+
+    FLUSH_EVERY = 1000
+    FLUSH_INTERVAL = 5.0
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.path.parent.mkdir(parents=True, exist_ok=True, mode=0o700)
+        self.conn = sqlite3.connect(str(path))
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS files (local TEXT PRIMARY KEY, remote TEXT NOT NULL, size INTEGER, mtime REAL, done INTEGER NOT NULL DEFAULT 0)")
+        self._done_buffer: List[str] = []
+        self._last_flush = time.time()
+
+    @classmethod
+    def for_sync(cls, bucket_name: str, src: Path, dstpath: str, relative_to: str = None) -> "TransferJournal":
+        key = json.dumps([bucket_name, str(src.resolve()), remote_prefix(dstpath), relative_to and str(Path(relative_to).resolve())])
+        return cls(Path(EBRAINS_UTIL_USER_PATH) / "journals" / f"sync-{sha256(key.encode('utf-8')).hexdigest()[:16]}.sqlite")
+
+    def is_planned(self) -> bool:
+        return self.conn.execute("SELECT value FROM meta WHERE key = 'planned'").fetchone() is not None
+
+    def plan(self, entries: Iterable[Tuple[str, str, int, float, bool]]):
+        """Merge the current transfer set, as (local, remote, size, mtime, done) tuples, into the journal.
+
+        New files, and files whose remote path, size or mtime changed since they were
+        recorded, take the done flag of the entry. Files no longer in the set are dropped.
+        Committed in one transaction."""
+        with self.conn:
+            self.conn.execute("DROP TABLE IF EXISTS temp.scan")
+            self.conn.execute("CREATE TEMP TABLE scan (local TEXT PRIMARY KEY, remote TEXT NOT NULL, size INTEGER, mtime REAL, done INTEGER NOT NULL)")
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO scan (local, remote, size, mtime, done) VALUES (?, ?, ?, ?, ?)",
+                ((local, remote, size, mtime, int(done)) for local, remote, size, mtime, done in entries))
+            self.conn.execute("DELETE FROM files WHERE local NOT IN (SELECT local FROM scan)")
+            self.conn.execute("""
+                INSERT INTO files (local, remote, size, mtime, done)
+                SELECT local, remote, size, mtime, done FROM scan WHERE true
+                ON CONFLICT(local) DO UPDATE SET
+                    remote = excluded.remote, size = excluded.size, mtime = excluded.mtime, done = excluded.done
+                WHERE files.remote != excluded.remote OR files.size != excluded.size OR files.mtime != excluded.mtime
+            """)
+            self.conn.execute("DROP TABLE scan")
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('planned', ?)", (str(time.time()),))
+
+    def counts(self) -> Tuple[int, int]:
+        """Returns (done, total)."""
+        done, total = self.conn.execute("SELECT COALESCE(SUM(done), 0), COUNT(*) FROM files").fetchone()
+        return done, total
+
+    def iter_pending(self) -> Iterator[Tuple[str, str]]:
+        """Yields (local, remote) not yet confirmed. Reads from a separate connection, so that
+        marking files done while iterating is safe."""
+        reader = sqlite3.connect(str(self.path))
+        try:
+            yield from reader.execute("SELECT local, remote FROM files WHERE done = 0")
+        finally:
+            reader.close()
+
+    def mark_done(self, local: str):
+        self._done_buffer.append(local)
+        if len(self._done_buffer) >= self.FLUSH_EVERY or time.time() - self._last_flush > self.FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        if self._done_buffer:
+            with self.conn:
+                self.conn.executemany("UPDATE files SET done = 1 WHERE local = ?", ((local,) for local in self._done_buffer))
+            self._done_buffer = []
+        self._last_flush = time.time()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+    def delete(self):
+        self.conn.close()
+        for suffix in ("", "-wal", "-shm"):
+            path = Path(f"{self.path}{suffix}")
+            if path.exists():
+                path.unlink()
+
+
+def remote_prefix(dstpath: str) -> str:
+    """Normalize dstpath to an object name prefix. Only "." and root segments are dropped,
+    names starting with a dot are kept as is."""
+    prefix = "/".join(part for part in PurePosixPath(dstpath).parts if part not in ("/", "."))
+    return f"{prefix}/" if prefix else ""
+
+
+def _parse_last_modified(last_modified: str) -> Optional[float]:
+    # data-proxy reports last_modified as ISO 8601, in UTC
+    try:
+        parsed = datetime.fromisoformat(last_modified.removesuffix("Z"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def list_remote(bucket, dstpath: str) -> Dict[str, Tuple[int, Optional[float]]]:
+    """Returns {name: (size, last modified timestamp)} of objects under dstpath. Lists the bucket once."""
+    prefix = remote_prefix(dstpath)
+    return {
+        f.name: (getattr(f, "bytes", None), _parse_last_modified(getattr(f, "last_modified", None)))
+        for f in bucket.ls(prefix=prefix or None)
+    }
+
+
+def plan_upload(src: Path, dstpath: str, relative_to: str = None, remote: Dict[str, Tuple[int, Optional[float]]] = None) -> Iterator[Tuple[str, str, int, float, bool]]:
+    """Yields (local, remote, size, mtime, done) for every file under src, streaming (no sorting).
+
+    Remote path is dstpath joined with the path relative to relative_to (-C) if provided,
+    otherwise relative to src if it is a directory, or to its parent if it is a file.
+    e.g. sync my-dir dest/ uploads my-dir/a/b.txt to dest/a/b.txt
+
+    If remote (see list_remote) is provided, a file is done if the object has the same size,
+    and was last modified no earlier than the local file."""
+    src = src.resolve()
+    base = Path(relative_to).resolve() if relative_to else (src if src.is_dir() else src.parent)
+    prefix = remote_prefix(dstpath)
+    remote = remote or {}
+
+    if src.is_file():
+        local_files = iter([src])
+    else:
+        local_files = (Path(dirpath) / filename for dirpath, _, filenames in os.walk(src) for filename in filenames)
+
+    for local_file in local_files:
+        try:
+            stat = local_file.stat()
+            relative = local_file.relative_to(base).as_posix()
+        except FileNotFoundError:
+            # e.g. broken symlink, or removed while walking
+            continue
+        except ValueError as e:
+            raise SyncIncompleteException(f"{str(local_file)} is not under -C {str(base)}") from e
+        remote_name = f"{prefix}{relative}"
+        remote_size, remote_modified = remote.get(remote_name, (None, None))
+        done = remote_size == stat.st_size and remote_modified is not None and remote_modified >= stat.st_mtime
+        yield str(local_file), remote_name, stat.st_size, stat.st_mtime, done
+
+
+def sync_with_journal(bucket_name: str, src: Path, dstpath: str, relative_to: str = None, max_workers: int = None, rescan: bool = False):
+    """Upload src to bucket, recording progress in a TransferJournal.
+
+    On first run, the destination is listed once, and files already uploaded (same size, not older
+    than the local file) are marked done. Other files are only marked done once uploaded.
+    If a journal of an interrupted run exists, its pending files are uploaded straight away,
+    without listing the bucket or walking src. With rescan, src is walked again first, so that new
+    and changed (size/mtime) files are picked up. The journal is deleted once every file is confirmed."""
+    journal = TransferJournal.for_sync(bucket_name, src, dstpath, relative_to)
+    pool = ClientPool(max_workers=max_workers)
+    pool.require_token()
+    bucket = pool.get_bucket(bucket_name)
+
+    if journal.is_planned():
+        print(f"Resuming from journal {str(journal.path)}", file=sys.stderr)
+        if rescan:
+            print("Rescanning source", file=sys.stderr)
+            journal.plan(plan_upload(src, dstpath, relative_to))
+    else:
+        print("Planning transfer", file=sys.stderr)
+        journal.plan(plan_upload(src, dstpath, relative_to, remote=list_remote(bucket, dstpath)))
+
+    done, total = journal.counts()
+    failed = []
+    # bound the number of in flight uploads, so that the pending set is never fully in memory
+    max_in_flight = pool.max_workers * 4
+    ex = ThreadPoolExecutor(max_workers=pool.max_workers)
+    try:
+        with tqdm.tqdm(total=total, initial=done) as progress:
+            in_flight = {}
+            pending = journal.iter_pending()
+            while True:
+                for local, remote in pending:
+                    in_flight[ex.submit(bucket.upload, local, remote)] = local
+                    if len(in_flight) >= max_in_flight:
+                        break
+                if not in_flight:
+                    break
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    local = in_flight.pop(future)
+                    error = future.exception()
+                    if error is not None:
+                        failed.append(local)
+                        progress.write(f"Failed to upload {local}: {str(error)}", file=sys.stderr)
+                        continue
+                    journal.mark_done(local)
+                    progress.update(1)
+    finally:
+        ex.shutdown(wait=False, cancel_futures=True)
+        journal.close()
+
+    if failed:
+        raise SyncIncompleteException(
+            f"{len(failed)} of {total} files failed to upload. Rerun with --resume to retry them. Journal: {str(journal.path)}")
+
+    journal.delete()
@@ -0,0 +1,372 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from itertools import chain, zip_longest
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+import threading
+
+from ebrains_drive import BucketApiClient
+from ebrains_drive.exceptions import ClientHttpError
+from ebrains_drive.utils import EBRAINS_DRIVE_MULTIPART_CHUNK_SIZE, EBRAINS_DRIVE_MULTIPART_THRESHOLD
+import requests
+from requests.adapters import HTTPAdapter
+
+from .util import parse_dataproxy_url
+from ..config import EBRAINS_UTIL_CHUNK_SIZE, EBRAINS_UTIL_MAX_WORKERS
+
+
+class ClientPool:
+    """Thread safe cache of the current token, bucket clients and pooled http sessions.
+
+    Meant to be long lived: token is only re-read when it expires, and bucket
+    metadata is fetched once per bucket."""
+
+    def __init__(self, max_workers: int = None) -> None:
+        self.max_workers = max_workers or EBRAINS_UTIL_MAX_WORKERS
+        self._lock = threading.Lock()
+        self._session: requests.Session = None
+        self._token = None
+        self._client: BucketApiClient = None
+        self._client_token: str = None
+        self._buckets = {}
+
+    def get_session(self) -> requests.Session:
+        """requests.Session shared by all threads (and, in the agent, all jobs), so connections are reused across transfers."""
+        with self._lock:
+            if self._session is None:
+                self._session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers)
+                self._session.mount("https://", adapter)
+                self._session.mount("http://", adapter)
+            return self._session
+
+    def get_token(self) -> Optional[str]:
+        """Returns the current token string, or None if not authenticated."""
+        from ..iam import get_current_token, TokenDoesNotExistException
+        with self._lock:
+            if self._token is None or self._token.is_expired():
+                try:
+                    _token = get_current_token()
+                    self._token = None if _token.is_expired() else _token
+                except TokenDoesNotExistException:
+                    self._token = None
+            return self._token and self._token.token
+
+    def require_token(self) -> str:
+        """Returns the current token string. Raises TokenDoesNotExistException if not authenticated."""
+        from ..iam import TokenDoesNotExistException
+        token = self.get_token()
+        if token is None:
+            raise TokenDoesNotExistException("No valid token found. Login with `ebrains_util iam auth login --scope team` first.")
+        return token
+
+    def invalidate_token(self):
+        """Force the token to be re-read on next use (e.g. after login/logout)."""
+        with self._lock:
+            self._token = None
+
+    def get_client(self) -> BucketApiClient:
+        token = self.get_token()
+        with self._lock:
+            if self._client is None or self._client_token != token:
+                # n.b. BucketApiClient(token=None) would prompt for username/password
+                self._client = BucketApiClient(token=token) if token else BucketApiClient()
+                self._client_token = token
+                self._buckets = {}
+            return self._client
+
+    def get_bucket(self, bucket_name: str):
+        client = self.get_client()
+        with self._lock:
+            bucket = self._buckets.get(bucket_name)
+        if bucket is None:
+            bucket = client.buckets.get_bucket(bucket_name)
+            with self._lock:
+                self._buckets[bucket_name] = bucket
+        return bucket
+
+    def get_download_link(self, bucket_name: str, filename: str) -> str:
+        """Get a (short lived) download link without listing the bucket (unlike bucket.get_file)."""
+        resp = self.get_client().get(f"/v1/buckets/{bucket_name}/{filename.lstrip('/')}", params={"redirect": False})
+        return resp.json().get("url")
+
+    def fetch(self, url: str, dest: Path):
+        """Stream url to dest. Writes to a temporary file first, so dest is never left half written."""
+        with self.get_session().get(url, stream=True) as resp:
+            resp.raise_for_status()
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            tmp_dest = dest.with_name(f"tmp_{dest.name}")
+            try:
+                with open(tmp_dest, "wb") as fp:
+                    for chunk in resp.iter_content(EBRAINS_UTIL_CHUNK_SIZE):
+                        fp.write(chunk)
+                tmp_dest.replace(dest)
+            finally:
+                if tmp_dest.exists():
+                    tmp_dest.unlink()
+
+
+class UrlDownloader:
+    """Download data-proxy URLs, remembering per bucket if anonymous access works.
+
+    The first URL of each bucket is tried anonymously. If it is rejected with 401/403,
+    all further URLs of the bucket go straight to the authenticated download link."""
+
+    ANONYMOUS_REJECTED = (401, 403)
+
+    def __init__(self, pool: ClientPool = None) -> None:
+        self.pool = pool or ClientPool()
+        self._anonymous: Dict[str, bool] = {}
+        self._lock = threading.Lock()
+        self._probe_locks: Dict[str, threading.Lock] = defaultdict(threading.Lock)
+
+    def _get_probe_lock(self, bucket_name: str) -> threading.Lock:
+        with self._lock:
+            return self._probe_locks[bucket_name]
+
+    def _try_anonymous(self, bucket_name: str, url: str, dest: Path) -> bool:
+        try:
+            self.pool.fetch(url, dest)
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code in self.ANONYMOUS_REJECTED:
+                self._anonymous[bucket_name] = False
+            return False
+        self._anonymous[bucket_name] = True
+        return True
+
+    def download(self, url: str, dest: Path):
+        bucket_name, _, filename = parse_dataproxy_url(url)
+        if not filename:
+            raise RuntimeError(f"{url=} does not point to a file")
+
+        if bucket_name not in self._anonymous:
+            # only one URL per bucket probes anonymous access, others wait for the verdict
+            with self._get_probe_lock(bucket_name):
+                if bucket_name not in self._anonymous:
+                    if self._try_anonymous(bucket_name, url, dest):
+                        return
+                    self._download_with_token(bucket_name, filename, dest)
+                    # anonymous failed but token worked (whatever the status), do not probe again
+                    self._anonymous[bucket_name] = False
+                    return
+
+        if self._anonymous.get(bucket_name):
+            self.pool.fetch(url, dest)
+            return
+        self._download_with_token(bucket_name, filename, dest)
+
+    def _download_with_token(self, bucket_name: str, filename: str, dest: Path):
+        self.pool.require_token()
+        link = self.pool.get_download_link(bucket_name, filename)
+        self.pool.fetch(link, dest)
+
+    def download_all(self, urls: Iterable[str], outdir: Path, callback: Callable[[str, Exception], None] = None) -> List[Tuple[str, Exception]]:
+        """Download all urls concurrently into outdir/<bucket-name>/<filepath>.
+        URLs resolving to an already queued destination are skipped.
+
+        Returns list of (url, exception) that failed."""
+        failed = []
+        by_bucket: Dict[str, List[Tuple[str, Path]]] = defaultdict(list)
+        seen_dests = set()
+        for url in urls:
+            try:
+                bucket_name, _, filename = parse_dataproxy_url(url)
+                if not filename:
+                    raise RuntimeError(f"{url=} does not point to a file")
+            except (RuntimeError, NotImplementedError) as e:
+                failed.append((url, e))
+                if callback:
+                    callback(url, e)
+                continue
+            dest = outdir / bucket_name / filename
+            # the same object may be listed more than once (e.g. with and without ?inline=true)
+            if dest in seen_dests:
+                if callback:
+                    callback(url, None)
+                continue
+            seen_dests.add(dest)
+            by_bucket[bucket_name].append((url, dest))
+
+        # interleave buckets, so that each bucket's access mode is probed early and in parallel
+        ordered = [job for job in chain.from_iterable(zip_longest(*by_bucket.values())) if job]
+
+        with ThreadPoolExecutor(max_workers=self.pool.max_workers) as ex:
+            futures = {ex.submit(self.download, url, dest): url for url, dest in ordered}
+            for future in as_completed(futures):
+                url = futures[future]
+                error = future.exception()
+                if error is not None:
+                    failed.append((url, error))
+                if callback:
+                    callback(url, error)
+        return failed
+
+
+class _ResponseReader:
+    """Exposes a streamed response as a sized file-like, so it can be used as an upload body.
+
+    n.b. deliberately not an IOBase: requests would call tell() on it, get UnsupportedOperation,
+    ignore __len__ and fall back to a chunked upload, which presigned urls reject."""
+    def __init__(self, resp: requests.Response, size: int) -> None:
+        self.resp = resp
+        self.resp.raw.decode_content = True
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def read(self, n=-1):
+        return self.resp.raw.read(None if n is None or n < 0 else n)
+
+
+@dataclass
+class CopyJob:
+    src_bucket: str
+    src_name: str
+    dst_bucket: str
+    dst_name: str
+
+    def __str__(self):
+        return f"{self.src_bucket}/{self.src_name} -> {self.dst_bucket}/{self.dst_name}"
+
+
+def plan_copy(pool: ClientPool, src_url: str, dst_url: str, recursive: bool = False) -> List[CopyJob]:
+    """Resolve src_url/dst_url (anything parse_dataproxy_url accepts) to a list of object copies.
+
+    Without recursive, src_url must point to an object. With recursive, src_url is used as a prefix,
+    and the path of each object relative to the prefix is preserved under dst_url."""
+    src_bucket, src_prefix, src_file = parse_dataproxy_url(src_url)
+    dst_bucket, dst_prefix, dst_file = parse_dataproxy_url(dst_url)
+
+    if not recursive:
+        if not src_file:
+            raise RuntimeError(f"{src_url=} does not point to a file. Use --recursive to copy a prefix.")
+        if dst_file and not dst_file.endswith("/"):
+            return [CopyJob(src_bucket, src_file, dst_bucket, dst_file)]
+        src_names = [src_file]
+        base = src_file[:src_file.rfind("/") + 1]
+    else:
+        prefix = src_file or src_prefix or ""
+        src_names = [f.name for f in pool.get_bucket(src_bucket).ls(prefix=prefix or None)]
+        base = prefix[:prefix.rfind("/") + 1]
+
+    dst_dir = dst_file or dst_prefix or ""
+    if dst_dir and not dst_dir.endswith("/"):
+        dst_dir = f"{dst_dir}/"
+    return [CopyJob(src_bucket, name, dst_bucket, f"{dst_dir}{name[len(base):]}") for name in src_names]
+
+
+class BucketCopier:
+    """Copy objects between buckets without going through local disk.
+
+    Uses the data-proxy server side copy. If the endpoint is not available, the download
+    stream is piped into the upload, buffering at most one part (EBRAINS_DRIVE_MULTIPART_CHUNK_SIZE)
+    per transfer."""
+
+    SERVER_COPY_UNAVAILABLE = (404, 405, 501)
+
+    def __init__(self, pool: ClientPool = None) -> None:
+        self.pool = pool or ClientPool()
+        self.server_copy = True
+
+    def copy(self, job: CopyJob):
+        self.pool.require_token()
+        if self.server_copy:
+            try:
+                self.pool.get_client().put(
+                    f"/v1/buckets/{job.src_bucket}/{job.src_name}/copy",
+                    params={"to": job.dst_bucket, "name": job.dst_name},
+                    expected=(200, 201, 204),
+                )
+                return
+            except ClientHttpError as e:
+                if e.code not in self.SERVER_COPY_UNAVAILABLE:
+                    raise
+                self._stream_copy(job)
+                # source exists, so it is the copy endpoint that is unavailable
+                self.server_copy = False
+                return
+        self._stream_copy(job)
+
+    def _stream_copy(self, job: CopyJob):
+        link = self.pool.get_download_link(job.src_bucket, job.src_name)
+        session = self.pool.get_session()
+        with session.get(link, stream=True) as resp:
+            resp.raise_for_status()
+            size = resp.headers.get("content-length") and int(resp.headers.get("content-length"))
+            headers = {}
+            if resp.headers.get("content-type"):
+                headers["Content-Type"] = resp.headers.get("content-type")
+
+            if size is None or size > EBRAINS_DRIVE_MULTIPART_THRESHOLD or resp.headers.get("content-encoding"):
+                self._stream_multipart(job, resp)
+                return
+
+            client = self.pool.get_client()
+            upload_url = client.put(f"/v1/buckets/{job.dst_bucket}/{job.dst_name}").json().get("url")
+            if upload_url is None:
+                raise RuntimeError(f"Did not get upload url for {job.dst_bucket}/{job.dst_name}")
+            # empty body must be explicit, a zero length stream is sent chunked
+            body = _ResponseReader(resp, size) if size else b""
+            upload_resp = session.put(upload_url, data=body, headers=headers)
+            upload_resp.raise_for_status()
+
+    def _stream_multipart(self, job: CopyJob, resp: requests.Response):
+        client = self.pool.get_client()
+        session = self.pool.get_session()
+        multipart_path = f"/v1/buckets/{job.dst_bucket}/{job.dst_name}/multipart"
+        upload_id = client.put(multipart_path).json().get("uploadId")
+        if not upload_id:
+            raise RuntimeError(f"Did not get multipart upload id for {job.dst_bucket}/{job.dst_name}")
+
+        etag_maps = {}
+        for part_number, chunk in enumerate(self._iter_parts(resp), start=1):
+            part_url = client.put(f"{multipart_path}/{upload_id}/{part_number}", params={"redirect": "false"}).json().get("url")
+            if not part_url:
+                raise RuntimeError(f"Did not get upload url for part {part_number} of {job.dst_bucket}/{job.dst_name}")
+            part_resp = session.put(part_url, data=chunk)
+            part_resp.raise_for_status()
+            etag_maps[str(part_number)] = part_resp.headers.get("etag", "").strip('"')
+
+        client.put(f"{multipart_path}/{upload_id}", params={"redirect": "false"}, json=etag_maps)
+
+    @staticmethod
+    def _iter_parts(resp: requests.Response):
+        """Re-chunk the response into parts of at least EBRAINS_DRIVE_MULTIPART_CHUNK_SIZE (except the last),
+        same as Bucket.multipart_upload."""
+        buffer = bytearray()
+        for data in resp.iter_content(EBRAINS_DRIVE_MULTIPART_CHUNK_SIZE):
+            buffer.extend(data)
+            if len(buffer) >= EBRAINS_DRIVE_MULTIPART_CHUNK_SIZE:
+                yield bytes(buffer)
+                buffer.clear()
+        if buffer:
+            yield bytes(buffer)
+
+    def copy_all(self, jobs: List[CopyJob], callback: Callable[[CopyJob, Exception], None] = None) -> List[Tuple[CopyJob, Exception]]:
+        """Copy all jobs concurrently. Returns list of (job, exception) that failed."""
+        failed = []
+        if not jobs:
+            return failed
+        # copy one object first, so that server side copy support is known before going parallel
+        first, *rest = jobs
+        try:
+            self.copy(first)
+            error = None
+        except Exception as e:
+            error = e
+            failed.append((first, e))
+        if callback:
+            callback(first, error)
+
+        with ThreadPoolExecutor(max_workers=self.pool.max_workers) as ex:
+            futures = {ex.submit(self.copy, job): job for job in rest}
+            for future in as_completed(futures):
+                job = futures[future]
+                error = future.exception()
+                if error is not None:
+                    failed.append((job, error))
+                if callback:
+                    callback(job, error)
+        return failed
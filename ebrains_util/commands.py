@@ -0,0 +1,128 @@
+import sys
+from io import BytesIO
+from pathlib import Path
+
+import click
+import tqdm
+from ebrains_drive import BucketApiClient
+
+from . import agent
+from .iam import iam, get_current_token
+from .bucket import bucket, parse_dataproxy_url
+from .bucket.transfer import ClientPool, UrlDownloader
+from .ingestion import ing
+
+
+@click.group()
+def cli():
+    """CLI to interact with ebrains services."""
+    pass
+
+
+cli.add_command(iam, "iam")
+
+cli.add_command(bucket, "bucket")
+
+cli.add_command(ing, "ing")
+
+
+@click.command()
+@click.option("--input", "-i", "input_file", help="Read URLs (one per line) from file. Use - to read from stdin.", type=str, default=None)
+@click.option("--outdir", "-o", help="With --input, files are downloaded to OUTDIR/<bucket-name>/<filepath>. Default to cwd.", type=str, default=".")
+@click.option("--max-workers", "max_workers", help="Configure max parallel", type=int, default=None)
+@click.argument("url", required=False, type=str)
+def _express_download(url: str, input_file: str, outdir: str, max_workers: int):
+    """Download a file given a URL. Will try public link, if fails, use token.
+
+    With --input, download many URLs concurrently. Whether a bucket allows anonymous
+    access is only checked once per bucket."""
+    if (url is None) == (input_file is None):
+        raise click.UsageError("Exactly one of URL or --input must be provided.")
+
+    downloader = UrlDownloader(ClientPool(max_workers=max_workers))
+
+    if url is not None:
+        bucketname, _, fname = parse_dataproxy_url(url)
+        if not fname:
+            raise click.UsageError(f"{url=} does not point to a file")
+        downloader.download(url, Path(fname))
+        print(f"Successfully downloaded {url}", file=sys.stderr)
+        return
+
+    if input_file == "-":
+        print("Reading stdin for URLs", file=sys.stderr)
+        lines = sys.stdin.read().splitlines()
+    else:
+        lines = Path(input_file).read_text().splitlines()
+    urls = [line.strip() for line in lines if line.strip() and not line.strip().startswith("#")]
+
+    with tqdm.tqdm(total=len(urls)) as progress:
+        def on_done(url: str, error: Exception):
+            progress.update(1)
+            if error is not None:
+                progress.write(f"Failed to download {url}: {str(error)}", file=sys.stderr)
+
+        failed = downloader.download_all(urls, Path(outdir), callback=on_done)
+
+    if failed:
+        print(f"{len(failed)} of {len(urls)} downloads failed.", file=sys.stderr)
+        sys.exit(1)
+    print(f"Successfully downloaded {len(urls)} files", file=sys.stderr)
+
+
+@click.command()
+@click.argument("url", required=True, type=str)
+@click.argument("file", required=True, type=str)
+def _express_upload(url: str, file: str):
+    """Upload a file. Use - at filename to read from stdin."""
+    bucketname, fpath, fname = parse_dataproxy_url(url)
+
+    token = get_current_token()
+    client = BucketApiClient(token=token.token)
+    bucket = client.buckets.get_bucket(bucketname)
+    if file == "-":
+        print("Reading stdin for upload", file=sys.stderr)
+        file = BytesIO(sys.stdin.buffer.read())
+        file.seek(0)
+
+    if fname:
+        print(f"Uploading to {bucketname=} {fname=}", file=sys.stderr)
+        bucket.upload(file, fname)
+        print("Success!", file=sys.stderr)
+        return
+
+    if fpath is None:
+        fpath = ""
+
+    assert not isinstance(
+        file, BytesIO
+    ), f"dir upload must either contain ?inline=true or use filename"
+    upload_path = f"{fpath}{Path(file).name}"
+    print(f"Uploading to {bucketname=} {upload_path=}", file=sys.stderr)
+    bucket.upload(file, upload_path)
+    print("Success!", file=sys.stderr)
+
+
+cli.add_command(_express_download, "download")
+cli.add_command(_express_upload, "upload")
+
+
+@click.command()
+@click.option("--stop", help="Stop the running agent.", is_flag=True)
+@click.option("--socket", "socket_path", help="Path of the unix socket. Default to EBRAINS_UTIL_AGENT_SOCKET.", type=str, default=None)
+def _serve(stop: bool, socket_path: str):
+    """Run a local agent in the foreground.
+
+    While it runs, `download`, `upload` and `bucket ls` are delegated to it, reusing
+    its token and connections, unless the caller's credential env vars differ from the
+    agent's. Set EBRAINS_UTIL_NO_AGENT=1 to bypass it."""
+    if stop:
+        if not agent.stop(socket_path):
+            print("Agent is not running.", file=sys.stderr)
+            sys.exit(1)
+        print("Agent stopped.", file=sys.stderr)
+        return
+    agent.serve(socket_path)
+
+
+cli.add_command(_serve, "serve")
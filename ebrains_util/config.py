@@ -10,5 +10,10 @@ EBRAINS_UTIL_REFRESH_TOKEN = os.getenv("EBRAINS_UTIL_REFRESH_TOKEN")
 EBRAINS_UTIL_TOKEN_SCOPE = os.getenv("EBRAINS_UTIL_TOKEN_SCOPE")
 
 EBRAINS_UTIL_CHUNK_SIZE = int(os.getenv("EBRAINS_UTIL_CHUNK_SIZE", 1024 * 1024 * 16))
+EBRAINS_UTIL_MAX_WORKERS = int(os.getenv("EBRAINS_UTIL_MAX_WORKERS", 8))
+
+EBRAINS_UTIL_AGENT_SOCKET = os.getenv("EBRAINS_UTIL_AGENT_SOCKET", os.path.join(EBRAINS_UTIL_USER_PATH, "agent.sock"))
+EBRAINS_UTIL_AGENT_LS_TTL = float(os.getenv("EBRAINS_UTIL_AGENT_LS_TTL", 0))
+EBRAINS_UTIL_NO_AGENT = os.getenv("EBRAINS_UTIL_NO_AGENT")
 
 token_path = Path(EBRAINS_UTIL_USER_PATH) / "auth_token"
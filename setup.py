@@ -19,7 +19,7 @@ setup(
     ],
     entry_points={
         "console_scripts": [
-            "ebrains_util = ebrains_util:cli"
+            "ebrains_util = ebrains_util.agent:main"
         ]
     }
 )